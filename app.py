@@ -1,10 +1,14 @@
 import sys
 import os
 import base64
+import io
 import json
+import functools
+import itertools
 import threading
 import time # For timestamps
 import sqlite3 # For database
+import queue # For the DB writer thread
 
 # Attempt to import necessary libraries and provide guidance if missing
 try:
@@ -14,14 +18,15 @@ try:
         QTabWidget, QMessageBox, QStatusBar, QSizePolicy, QScrollArea,
         QDialog, QFormLayout, QDialogButtonBox, QInputDialog, QMenu
     )
-    from PyQt5.QtGui import QFont, QPixmap, QImage, QColor, QPalette, QIcon, QTextCursor, QTextDocument, QTextImageFormat
-    from PyQt5.QtCore import Qt, pyqtSignal, QThread, QSize, QUrl
+    from PyQt5.QtGui import QFont, QPixmap, QImage, QImageReader, QColor, QPalette, QIcon, QTextCursor, QTextDocument, QTextImageFormat, QTextCharFormat
+    from PyQt5.QtCore import Qt, pyqtSignal, QObject, QThread, QSize, QUrl, QStringListModel
 except ImportError:
     print("PyQt5 not found. Please install it: pip install PyQt5")
     sys.exit(1)
 
 try:
     import requests
+    from requests.adapters import HTTPAdapter
 except ImportError:
     print("requests not found. Please install it: pip install requests")
     sys.exit(1)
@@ -41,147 +46,434 @@ except ImportError:
     sr = None
 
 try:
-    from PIL import Image, ImageQt # Pillow
+    from PIL import Image, ImageOps, ImageQt # Pillow
 except ImportError:
     print("Pillow not found. Please install it: pip install Pillow")
     Image = None
+    ImageOps = None
     ImageQt = None
 
+try:
+    import orjson # Faster JSON encoding of request bodies (large base64 image payloads)
+except ImportError:
+    print("orjson not found, using json. For faster requests: pip install orjson")
+    orjson = None
+
+try:
+    import pybase64 # SIMD-accelerated base64
+except ImportError:
+    print("pybase64 not found, using base64. For faster image encoding: pip install pybase64")
+    pybase64 = None
+
 
 # --- Configuration ---
 DEFAULT_OLLAMA_URL = "http://localhost:11434"
 APP_TITLE = "Ollama Advanced Chat 🧠"
 VERSION = "1.1.0" # Version updated
 DATABASE_NAME = "ollama_chat.db"
+HISTORY_DISPLAY_LIMIT = 200 # Most recent messages rendered when a chat is opened
+IMAGE_MAX_EDGE = 1568 # Attached images are downscaled to this long edge before sending
+IMAGE_JPEG_QUALITY = 85
+CHAT_IMAGE_WIDTH = 150 # Display width of image thumbnails in the chat area
+OLLAMA_HISTORY_MAX_MESSAGES = 40 # Sliding window of past messages sent with each request
+OLLAMA_HISTORY_MAX_CHARS = 12000 # ...further trimmed to roughly this much content
+OLLAMA_CHAT_TIMEOUT = (3.05, 120) # (connect, read) seconds: fail fast if Ollama is unreachable
+OLLAMA_TAGS_TIMEOUT = (3.05, 10) # (connect, read) seconds for the /api/tags model list
+FILE_BASE64_CACHE_MAX_BYTES = 512 * 1024 # Larger files sent as-is are re-read each time rather than cached
+MODEL_LIST_CACHE_SECONDS = 30 # /api/tags results are reused for this long per Ollama URL
+
+# Applied once on the QApplication (see __main__) so every window and dialog shares one parsed copy
+_STYLESHEET = """
+    QMainWindow, QWidget { background-color: #2E3440; color: #D8DEE9; font-family: Inter, sans-serif; }
+    QTabWidget::pane { border-top: 2px solid #4C566A; }
+    QTabBar::tab { background: #3B4252; color: #D8DEE9; border: 1px solid #4C566A; border-bottom-color: #3B4252; padding: 8px 15px; margin-right: 2px; border-top-left-radius: 4px; border-top-right-radius: 4px; }
+    QTabBar::tab:selected { background: #434C5E; color: #ECEFF4; border-bottom-color: #434C5E; }
+    QTabBar::tab:hover { background: #4C566A; }
+    /* QTabBar::close-button styling might be OS dependent or need specific icons */
+    QPushButton { background-color: #5E81AC; color: #ECEFF4; border: none; padding: 8px 12px; border-radius: 4px; font-weight: bold; }
+    QPushButton:hover { background-color: #81A1C1; } QPushButton:pressed { background-color: #4C566A; }
+    QLineEdit, QTextEdit, QComboBox { background-color: #3B4252; color: #D8DEE9; border: 1px solid #4C566A; border-radius: 4px; padding: 6px; }
+    QComboBox::drop-down { border: none; }
+    QLabel { color: #D8DEE9; } QStatusBar { background-color: #3B4252; color: #ECEFF4; }
+    QMenuBar { background-color: #3B4252; color: #ECEFF4; }
+    QMenuBar::item { background-color: #3B4252; color: #ECEFF4; padding: 4px 8px; }
+    QMenuBar::item:selected { background-color: #4C566A; }
+    QMenu { background-color: #3B4252; color: #ECEFF4; border: 1px solid #4C566A; }
+    QMenu::item:selected { background-color: #5E81AC; }
+"""
 
 # --- Helper Functions ---
+_HTML_ESCAPE = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;", "\n": "<br>"})
+_b64encode = pybase64.b64encode if pybase64 else base64.b64encode
+_json_loads = orjson.loads if orjson else json.loads
+
+def json_dumps_bytes(obj):
+    """Serializes obj to UTF-8 JSON bytes (orjson when available)."""
+    return orjson.dumps(obj) if orjson else json.dumps(obj).encode('utf-8')
+
 def get_timestamp():
-    """Returns a formatted timestamp."""
-    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+    """Returns the current time as integer UNIX epoch seconds (the DB storage format)."""
+    return int(time.time())
+
+def format_timestamp(timestamp):
+    """Formats an epoch-seconds timestamp for display."""
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp))
+
+def window_history(messages, max_messages=OLLAMA_HISTORY_MAX_MESSAGES, max_chars=OLLAMA_HISTORY_MAX_CHARS):
+    """Returns the newest messages (oldest first) that fit the message and character budgets; always keeps the last one."""
+    window = []
+    total_chars = 0
+    for message in reversed(messages[-max_messages:]):
+        total_chars += len(message["content"])
+        if window and total_chars > max_chars: break
+        window.append(message)
+    window.reverse()
+    return window
+
+def _read_file_base64(image_path):
+    with open(image_path, "rb") as image_file:
+        return _b64encode(image_file.read()).decode('ascii') # base64 output is pure ASCII
+
+@functools.lru_cache(maxsize=16)
+def _cached_small_file_base64(image_path, mtime_ns, size):
+    """Base64 of a small file; mtime_ns/size are part of the cache key so edited files are re-read."""
+    return _read_file_base64(image_path)
+
+def _file_base64(image_path, mtime_ns, size):
+    """Base64 of a file, cached only below FILE_BASE64_CACHE_MAX_BYTES so big attachments aren't pinned in memory."""
+    if size > FILE_BASE64_CACHE_MAX_BYTES: return _read_file_base64(image_path)
+    return _cached_small_file_base64(image_path, mtime_ns, size)
+
+@functools.lru_cache(maxsize=32)
+def _cached_image_jpeg_base64(image_path, mtime_ns, size):
+    """Downscaled JPEG re-encode of an image as base64, or None when the original file is smaller (see prepare_image_base64)."""
+    with Image.open(image_path) as img:
+        resized = max(img.size) > IMAGE_MAX_EDGE
+        img = ImageOps.exif_transpose(img) # Re-encoding drops EXIF, so bake the orientation into the pixels
+        img.thumbnail((IMAGE_MAX_EDGE, IMAGE_MAX_EDGE), Image.LANCZOS)
+        if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+            # JPEG has no alpha: flatten onto white instead of letting convert("RGB") turn transparent areas black
+            rgba = img.convert("RGBA")
+            img = Image.new("RGB", rgba.size, (255, 255, 255))
+            img.paste(rgba, mask=rgba.getchannel("A"))
+        buf = io.BytesIO()
+        img.convert("RGB").save(buf, "JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+    if not resized and buf.tell() >= size:
+        return None # Not the original's base64: that would pin big files here, bypassing the _file_base64 size cap
+    return _b64encode(buf.getvalue()).decode('ascii')
+
+def prepare_image_base64(image_path):
+    """Returns a base64 payload for an attached image, shrunk for the Ollama request when Pillow is available."""
+    if not Image: return to_base64(image_path)
+    try:
+        stat = os.stat(image_path)
+        encoded = _cached_image_jpeg_base64(image_path, stat.st_mtime_ns, stat.st_size)
+        return encoded if encoded is not None else _file_base64(image_path, stat.st_mtime_ns, stat.st_size)
+    except Exception as e:
+        print(f"Error preparing image {image_path}: {e}. Sending original file.")
+        return to_base64(image_path)
 
 def to_base64(image_path):
     """Converts an image file to a base64 string."""
     try:
-        with open(image_path, "rb") as image_file:
-            return base64.b64encode(image_file.read()).decode('utf-8')
+        stat = os.stat(image_path)
+        return _file_base64(image_path, stat.st_mtime_ns, stat.st_size)
     except Exception as e:
         print(f"Error encoding image to base64: {e}")
         return None
 
+@functools.lru_cache(maxsize=64)
+def _cached_chat_thumbnail(image_path, mtime, max_width):
+    """Image decoded straight at thumbnail size (no full-resolution decode); a null QImage if unreadable."""
+    reader = QImageReader(image_path)
+    size = reader.size()
+    if size.isValid() and size.width() > max_width:
+        reader.setScaledSize(QSize(max_width, max(1, round(size.height() * max_width / size.width()))))
+    return reader.read()
+
+# --- HTTP Session ---
+def create_http_session():
+    """Keep-alive session so repeated Ollama calls (tags, chat) reuse pooled connections."""
+    session = requests.Session()
+    session.mount("http://", HTTPAdapter(pool_connections=10, pool_maxsize=10, max_retries=0))
+    session.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=10, max_retries=0))
+    session.headers.update({
+        "Connection": "keep-alive",
+        "Accept-Encoding": "gzip, deflate",
+        "User-Agent": f"OllamaAdvancedChat/{VERSION}", # HTTP headers must be latin-1, so not APP_TITLE
+    })
+    return session
+
 # --- Database Manager ---
 class DatabaseManager:
     def __init__(self, db_name=DATABASE_NAME):
         self.db_name = db_name
         self.conn = None
+        self._dirty_access = {} # conversation_id -> last_accessed_at not yet written (see flush_access)
         self._connect()
         self._create_tables()
 
     def _connect(self):
-        self.conn = sqlite3.connect(self.db_name)
+        # Connection.execute reuses prepared statements from the per-connection cache
+        self.conn = sqlite3.connect(self.db_name, cached_statements=256)
         self.conn.row_factory = sqlite3.Row # Access columns by name
+        # WAL makes each commit a sequential append; NORMAL sync is safe with WAL
+        self.conn.execute("PRAGMA journal_mode = WAL;")
+        self.conn.execute("PRAGMA synchronous = NORMAL;")
+        self.conn.execute("PRAGMA temp_store = MEMORY;")
+        self.conn.execute("PRAGMA cache_size = -20000;") # ~20 MB page cache
+        self.conn.execute("PRAGMA mmap_size = 268435456;") # 256 MB
         # Enable Foreign Key support
         self.conn.execute("PRAGMA foreign_keys = ON;")
 
 
+    SCHEMA_VERSION = 1 # PRAGMA user_version once the integer-timestamp migration has run
+
     def _create_tables(self):
-        cursor = self.conn.cursor()
-        # Conversations Table
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS conversations (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                ollama_model TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                last_accessed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        # Messages Table
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                conversation_id INTEGER NOT NULL,
-                role TEXT NOT NULL, -- 'user', 'assistant', 'system'
-                content TEXT NOT NULL,
-                timestamp TIMESTAMP NOT NULL,
-                image_path TEXT,      -- Store path to image file
-                rag_filename TEXT,    -- Store filename of RAG document
-                FOREIGN KEY (conversation_id) REFERENCES conversations(id) ON DELETE CASCADE
-            )
-        """)
-        self.conn.commit()
+        with self.conn:
+            # Conversations Table
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS conversations (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    name TEXT NOT NULL,
+                    ollama_model TEXT,
+                    created_at INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
+                    last_accessed_at INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER))
+                )
+            """)
+            # Messages Table
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    conversation_id INTEGER NOT NULL,
+                    role TEXT NOT NULL, -- 'user', 'assistant', 'system'
+                    content TEXT NOT NULL,
+                    timestamp INTEGER NOT NULL, -- UNIX epoch seconds
+                    image_path TEXT,      -- Store path to image file
+                    rag_filename TEXT,    -- Store filename of RAG document
+                    FOREIGN KEY (conversation_id) REFERENCES conversations(id) ON DELETE CASCADE
+                )
+            """)
+            # Indexes for per-conversation history reads and the tab list ordering.
+            # idx_messages_conv_ts also serves the "ORDER BY timestamp, id" tie-break (the rowid is the
+            # implicit last index column), so history queries need no sort step and no separate (conversation_id, id) index.
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_conv_ts ON messages (conversation_id, timestamp)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_conversations_accessed ON conversations (last_accessed_at DESC)")
+            # Databases from v1.1.0 stored local-time "%Y-%m-%d %H:%M:%S" strings; convert them to epoch seconds
+            # (mixed text/integer values would not sort chronologically). Runs once per file, not per connection.
+            if self.conn.execute("PRAGMA user_version").fetchone()[0] < self.SCHEMA_VERSION:
+                for table, column in (("messages", "timestamp"), ("conversations", "created_at"), ("conversations", "last_accessed_at")):
+                    self.conn.execute(f"""
+                        UPDATE {table} SET {column} = CAST(strftime('%s', {column}, 'utc') AS INTEGER)
+                        WHERE typeof({column}) = 'text'
+                    """)
+                self.conn.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
 
     def add_conversation(self, name, ollama_model=None):
-        cursor = self.conn.cursor()
         timestamp = get_timestamp()
-        cursor.execute("""
-            INSERT INTO conversations (name, ollama_model, created_at, last_accessed_at)
-            VALUES (?, ?, ?, ?)
-        """, (name, ollama_model, timestamp, timestamp))
-        self.conn.commit()
+        with self.conn:
+            cursor = self.conn.execute("""
+                INSERT INTO conversations (name, ollama_model, created_at, last_accessed_at)
+                VALUES (?, ?, ?, ?)
+            """, (name, ollama_model, timestamp, timestamp))
         return cursor.lastrowid
 
     def rename_conversation(self, conversation_id, new_name):
-        cursor = self.conn.cursor()
-        cursor.execute("UPDATE conversations SET name = ? WHERE id = ?", (new_name, conversation_id))
-        self.conn.commit()
+        with self.conn:
+            self.conn.execute("UPDATE conversations SET name = ? WHERE id = ?", (new_name, conversation_id))
 
     def delete_conversation(self, conversation_id):
-        cursor = self.conn.cursor()
-        # Foreign key ON DELETE CASCADE should handle messages
-        cursor.execute("DELETE FROM conversations WHERE id = ?", (conversation_id,))
-        self.conn.commit()
+        # Single statement: ON DELETE CASCADE removes the messages too (foreign_keys is enabled in _connect)
+        with self.conn:
+            self.conn.execute("DELETE FROM conversations WHERE id = ?", (conversation_id,))
 
     def get_all_conversations(self):
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT id, name, ollama_model, last_accessed_at FROM conversations ORDER BY last_accessed_at DESC")
-        return cursor.fetchall()
+        return self.conn.execute("SELECT id, name, ollama_model, last_accessed_at FROM conversations ORDER BY last_accessed_at DESC").fetchall()
+
+    def get_conversation_model(self, conversation_id):
+        row = self.conn.execute("SELECT ollama_model FROM conversations WHERE id = ?", (conversation_id,)).fetchone()
+        return row['ollama_model'] if row else None
+
+    _INSERT_MESSAGE_SQL = """
+        INSERT INTO messages (conversation_id, role, content, timestamp, image_path, rag_filename)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """
 
     def add_message(self, conversation_id, role, content, timestamp, image_path=None, rag_filename=None):
-        cursor = self.conn.cursor()
-        cursor.execute("""
-            INSERT INTO messages (conversation_id, role, content, timestamp, image_path, rag_filename)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (conversation_id, role, content, timestamp, image_path, rag_filename))
-        self.conn.commit()
-        self.update_conversation_accessed_time(conversation_id) # Update last accessed time
+        with self.conn:
+            cursor = self.conn.execute(self._INSERT_MESSAGE_SQL, (conversation_id, role, content, timestamp, image_path, rag_filename))
+        self._dirty_access[conversation_id] = get_timestamp() # Last accessed time is written by flush_access
         return cursor.lastrowid
 
+    def add_messages(self, conversation_id, rows):
+        """Bulk-inserts (role, content, timestamp, image_path, rag_filename) rows in a single transaction."""
+        self.bulk_add_messages((conversation_id,) + tuple(row) for row in rows)
+
+    BULK_INSERT_CHUNK_ROWS = 5000
+
+    def bulk_add_messages(self, rows_iter):
+        """Inserts full (conversation_id, role, content, timestamp, image_path, rag_filename) rows, e.g. for
+        history restore/import. Rows are consumed in chunks, so huge iterables are never held in memory."""
+        with self.conn: # One transaction for the whole import
+            conversation_ids = self._insert_message_rows(rows_iter)
+        timestamp = get_timestamp()
+        for conv_id in conversation_ids: self._dirty_access[conv_id] = timestamp
+
+    def _insert_message_rows(self, rows_iter):
+        """executemany in BULK_INSERT_CHUNK_ROWS chunks inside the caller's transaction; returns the conversation ids."""
+        rows_iter = iter(rows_iter)
+        conversation_ids = set()
+        while True:
+            chunk = list(itertools.islice(rows_iter, self.BULK_INSERT_CHUNK_ROWS))
+            if not chunk: break
+            self.conn.executemany(self._INSERT_MESSAGE_SQL, chunk)
+            conversation_ids.update(row[0] for row in chunk)
+        return conversation_ids
+
     def get_messages(self, conversation_id):
-        cursor = self.conn.cursor()
-        cursor.execute("""
+        return self.conn.execute("""
+            SELECT id, role, content, timestamp, image_path, rag_filename
+            FROM messages WHERE conversation_id = ? ORDER BY timestamp ASC, id ASC
+        """, (conversation_id,)).fetchall()
+
+    def iter_messages(self, conversation_id):
+        """Like get_messages, but yields rows from the cursor instead of fetching them all."""
+        return self.conn.execute("""
             SELECT id, role, content, timestamp, image_path, rag_filename
-            FROM messages WHERE conversation_id = ? ORDER BY timestamp ASC
+            FROM messages WHERE conversation_id = ? ORDER BY timestamp ASC, id ASC
         """, (conversation_id,))
-        return cursor.fetchall()
+
+    def get_messages_tail(self, conversation_id, limit):
+        """Returns the most recent `limit` messages of a conversation, oldest first."""
+        rows = self.conn.execute("""
+            SELECT id, role, content, timestamp, image_path, rag_filename
+            FROM messages WHERE conversation_id = ? ORDER BY timestamp DESC, id DESC LIMIT ?
+        """, (conversation_id, limit)).fetchall()
+        rows.reverse()
+        return rows
 
     def update_conversation_accessed_time(self, conversation_id):
-        cursor = self.conn.cursor()
+        with self.conn:
+            self.conn.execute("UPDATE conversations SET last_accessed_at = ? WHERE id = ?", (get_timestamp(), conversation_id))
+
+    def apply_writes(self, ops):
+        """Applies queued ("add_message" | "update_conversation_model", params) ops in one transaction."""
+        message_rows = [params for op, params in ops if op == "add_message"]
+        model_updates = [params for op, params in ops if op == "update_conversation_model"]
+        with self.conn:
+            conversation_ids = self._insert_message_rows(message_rows) # Same bulk path as bulk_add_messages
+            if model_updates:
+                self.conn.executemany("UPDATE conversations SET ollama_model = ? WHERE id = ?", model_updates)
         timestamp = get_timestamp()
-        cursor.execute("UPDATE conversations SET last_accessed_at = ? WHERE id = ?", (timestamp, conversation_id))
-        self.conn.commit()
-        
+        for conv_id in conversation_ids | {params[1] for params in model_updates}:
+            self._dirty_access[conv_id] = timestamp
+
     def update_conversation_model(self, conversation_id, model_name):
-        cursor = self.conn.cursor()
-        cursor.execute("UPDATE conversations SET ollama_model = ? WHERE id = ?", (model_name, conversation_id))
-        self.conn.commit()
-        self.update_conversation_accessed_time(conversation_id)
+        with self.conn:
+            self.conn.execute("UPDATE conversations SET ollama_model = ? WHERE id = ?", (model_name, conversation_id))
+        self._dirty_access[conversation_id] = get_timestamp()
+
+    def flush_access(self):
+        """Writes all pending last_accessed_at updates in one statement batch."""
+        if not self._dirty_access: return
+        pairs = [(timestamp, conv_id) for conv_id, timestamp in self._dirty_access.items()]
+        with self.conn:
+            self.conn.executemany("UPDATE conversations SET last_accessed_at = ? WHERE id = ?", pairs)
+        self._dirty_access.clear()
 
 
     def close(self):
         if self.conn:
+            self.flush_access()
             self.conn.close()
 
-# --- Worker Threads (Unchanged from previous version) ---
+# --- Worker Threads ---
+class DbWriterThread(QThread):
+    """Applies queued DB writes on its own connection, coalescing bursts into one commit."""
+    error_occurred = pyqtSignal(str)
+    BATCH_MAX_OPS = 200
+    BATCH_WINDOW_SECONDS = 0.05
+    ACCESS_FLUSH_SECONDS = 5 # How often coalesced last_accessed_at updates are written
+    _IDLE = object() # Wake-up marker when no write arrived before the next access flush
+
+    def __init__(self, db_name=DATABASE_NAME):
+        super().__init__()
+        self.db_name = db_name
+        self._queue = queue.Queue()
+
+    def enqueue(self, op):
+        """Queues an (op_name, params) write; see DatabaseManager.apply_writes."""
+        self._queue.put(op)
+
+    def flush(self):
+        """Blocks until every queued write has been committed."""
+        if self.isRunning(): self._queue.join()
+
+    def stop(self):
+        """Flushes pending writes and stops the thread."""
+        if self.isRunning():
+            self._queue.put(None)
+            self.wait()
+
+    def _apply_batch(self, db, batch):
+        try: db.apply_writes(batch)
+        except sqlite3.IntegrityError:
+            # One bad op (e.g. a reply for a conversation deleted mid-stream) rolled back the whole batch;
+            # replay the ops one by one so other tabs' writes still land
+            for op in batch:
+                try: db.apply_writes([op])
+                except sqlite3.IntegrityError as e: self.error_occurred.emit(f"Dropped a database write: {e}")
+
+    def run(self):
+        db = DatabaseManager(self.db_name) # sqlite3 connections must stay on the thread that made them
+        next_access_flush = time.monotonic() + self.ACCESS_FLUSH_SECONDS
+        stopping = False
+        while not stopping:
+            try: op = self._queue.get(timeout=max(0.0, next_access_flush - time.monotonic()))
+            except queue.Empty: op = self._IDLE
+            batch = []
+            if op is None: stopping = True
+            elif op is not self._IDLE:
+                batch.append(op)
+                deadline = time.monotonic() + self.BATCH_WINDOW_SECONDS
+                while len(batch) < self.BATCH_MAX_OPS:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0: break
+                    try: op = self._queue.get(timeout=remaining)
+                    except queue.Empty: break
+                    if op is None: stopping = True; break
+                    batch.append(op)
+            try:
+                if batch: self._apply_batch(db, batch)
+                if time.monotonic() >= next_access_flush:
+                    db.flush_access()
+                    next_access_flush = time.monotonic() + self.ACCESS_FLUSH_SECONDS
+            except sqlite3.Error as e: self.error_occurred.emit(f"Database write error: {e}")
+            for _ in range(len(batch) + stopping): self._queue.task_done()
+        try: db.close() # Also flushes pending last_accessed_at updates
+        except sqlite3.Error as e: self.error_occurred.emit(f"Database write error: {e}")
+
 class OllamaRequestThread(QThread):
     response_received = pyqtSignal(object)
+    chunk_received = pyqtSignal(str) # Incremental content when streaming
     error_occurred = pyqtSignal(str)
-    def __init__(self, ollama_url, model_name, messages, stream=False, images=None):
+    def __init__(self, ollama_url, model_name, messages, stream=False, images=None, http=None):
         super().__init__()
+        self.http = http if http is not None else requests # Shared requests.Session when given
         self.ollama_url = ollama_url
         self.model_name = model_name
         self.messages = messages # This is the history for Ollama API
         self.stream = stream
         self.images = images if images else []
+        self._response = None # In-flight streaming response, closed by cancel()
+        self._cancelled = False
+    def cancel(self):
+        """Stops a streaming generation; closing the response aborts the read in run()."""
+        self._cancelled = True
+        response = self._response
+        if response is not None:
+            try: response.close()
+            except Exception: pass
     def run(self):
         try:
             payload = { "model": self.model_name, "messages": self.messages, "stream": self.stream }
@@ -193,12 +485,130 @@ class OllamaRequestThread(QThread):
                     self.error_occurred.emit("Cannot send image without a user message context.")
                     return
             api_url = f"{self.ollama_url}/api/chat"
-            response = requests.post(api_url, json=payload, timeout=120)
-            response.raise_for_status()
-            self.response_received.emit(response.json())
-        except requests.exceptions.RequestException as e: self.error_occurred.emit(f"Network/API Error: {e}")
+            body = json_dumps_bytes(payload)
+            headers = {"Content-Type": "application/json"}
+            if not self.stream:
+                response = self.http.post(api_url, data=body, headers=headers, timeout=OLLAMA_CHAT_TIMEOUT)
+                response.raise_for_status()
+                self.response_received.emit(response.json())
+                return
+            # Streaming: Ollama sends one JSON object per line; the last one has "done": true
+            content_parts = []
+            final_data = {}
+            with self.http.post(api_url, data=body, headers=headers, stream=True, timeout=OLLAMA_CHAT_TIMEOUT) as response:
+                self._response = response
+                # Stop pressed while connecting / waiting for headers (e.g. model loading): cancel() had nothing to
+                # close yet, so close now (the with block) rather than block in the first read for up to the read timeout
+                if self._cancelled: return
+                response.raise_for_status()
+                try:
+                    for line in response.iter_lines():
+                        if self._cancelled: break
+                        if not line: continue
+                        data = _json_loads(line)
+                        if data.get("error"): self.error_occurred.emit(f"Ollama error: {data['error']}"); return
+                        chunk = data.get("message", {}).get("content", "")
+                        if chunk:
+                            content_parts.append(chunk)
+                            self.chunk_received.emit(chunk)
+                        if data.get("done"): final_data = data; break
+                except Exception:
+                    # Closing the response from cancel() surfaces as ChunkedEncodingError or similar
+                    if not self._cancelled: raise
+            if self._cancelled:
+                if not content_parts: return
+                final_data = {"done": False, "cancelled": True} # Keep the partial reply that is already on screen
+            final_data["message"] = {"role": "assistant", "content": "".join(content_parts)}
+            self.response_received.emit(final_data) # Full reply, same shape as the non-streaming response
+        except requests.exceptions.RequestException as e:
+            if not self._cancelled: self.error_occurred.emit(f"Network/API Error: {e}")
         except json.JSONDecodeError: self.error_occurred.emit("Error decoding JSON response.")
         except Exception as e: self.error_occurred.emit(f"Unexpected error: {e}")
+        finally: self._response = None
+
+class ModelLoaderWorker(QObject):
+    """Fetches /api/tags off the GUI thread; finished delivers (models, error or None)."""
+    finished = pyqtSignal(list, object)
+    def __init__(self, http, ollama_url):
+        super().__init__()
+        self.http = http
+        self.ollama_url = ollama_url
+    def run(self):
+        try:
+            response = self.http.get(f"{self.ollama_url}/api/tags", timeout=OLLAMA_TAGS_TIMEOUT)
+            response.raise_for_status()
+            self.finished.emit(response.json().get("models", []), None)
+        except Exception as e: self.finished.emit([], e)
+
+class PdfExtractThread(QThread):
+    text_ready = pyqtSignal(str)
+    extraction_error = pyqtSignal(str)
+    def __init__(self, file_path):
+        super().__init__()
+        self.file_path = file_path
+    def run(self):
+        try:
+            with open(self.file_path, "rb") as f:
+                reader = PyPDF2.PdfReader(f)
+                parts = [(page.extract_text() or "") for page in reader.pages] # Joined once, not concatenated per page
+            self.text_ready.emit("\n".join(parts).strip())
+        except Exception as e: self.extraction_error.emit(str(e))
+
+class ExportChatThread(QThread):
+    """Writes a conversation to .json or .txt on its own DB connection, streaming rows straight to the file."""
+    progress = pyqtSignal(int)
+    export_finished = pyqtSignal(str)
+    export_error = pyqtSignal(str)
+    PROGRESS_EVERY_ROWS = 1000
+    ROLE_CAP = {"user": "User", "assistant": "Assistant", "system": "System"} # Role labels for .txt exports
+    def __init__(self, conversation_id, file_path, chat_name, model_name, db_name=DATABASE_NAME):
+        super().__init__()
+        self.conversation_id = conversation_id
+        self.file_path = file_path
+        self.chat_name = chat_name
+        self.model_name = model_name
+        self.db_name = db_name
+    def run(self):
+        db = None
+        try:
+            db = DatabaseManager(self.db_name) # sqlite3 connections must stay on the thread that made them
+            rows = db.iter_messages(self.conversation_id)
+            with open(self.file_path, 'w', encoding='utf-8') as f:
+                if self.file_path.endswith(".json"): count = self._write_json(f, rows)
+                else: count = self._write_txt(f, rows)
+            self.export_finished.emit(f"Chat exported to {os.path.basename(self.file_path)} ({count} messages)")
+        except Exception as e: self.export_error.emit(str(e))
+        finally:
+            if db: db.close()
+    def _export_rows(self, rows):
+        # Rows unpack positionally in iter_messages' column order (cheaper than sqlite3.Row lookups by name)
+        for count, (_id, role, content, timestamp, image_path, rag_filename) in enumerate(rows, 1):
+            if count % self.PROGRESS_EVERY_ROWS == 0: self.progress.emit(count)
+            yield {"role": role, "content": content, "timestamp": format_timestamp(timestamp),
+                   "image_path": image_path, "rag_filename": rag_filename}
+    def _write_json(self, f, rows):
+        # Same output as json.dump(list, f, indent=2), one message at a time
+        count = 0
+        for message in self._export_rows(rows):
+            f.write(",\n  " if count else "[\n  ")
+            f.write(json.dumps(message, indent=2).replace("\n", "\n  ")) # Newlines in values are escaped, so this only indents
+            count += 1
+        f.write("\n]" if count else "[]")
+        return count
+    def _write_txt(self, f, rows):
+        count = 0
+        basename = functools.lru_cache(maxsize=128)(os.path.basename) # The same few image paths repeat across messages
+        role_cap = self.ROLE_CAP
+        f.write(f"Chat History: {self.chat_name} - Exported: {format_timestamp(get_timestamp())}\n")
+        f.write(f"Model (last used in tab): {self.model_name}\n\n")
+        for message in self._export_rows(rows):
+            role = message['role']
+            f.write(f"[{message['timestamp']}] {role_cap.get(role) or role.capitalize()}:\n{message['content']}\n")
+            if message['image_path']: f.write(f"(Image: {basename(message['image_path'])})\n")
+            if message['rag_filename']: f.write(f"(RAG Doc: {message['rag_filename']})\n")
+            f.write("\n---\n\n")
+            count += 1
+        return count
 
 class AudioRecognitionThread(QThread):
     transcription_ready = pyqtSignal(str)
@@ -231,15 +641,28 @@ class AudioRecognitionThread(QThread):
         except Exception as e: self.recognition_error.emit(f"Audio recognition error: {e}")
 
 # --- Chat Widget for each Tab ---
+class ModelList:
+    """The model names from one /api/tags fetch, built once and shared by every tab's dropdown."""
+    def __init__(self, available_models, parent=None):
+        self.names = tuple(m.get("name", "N/A") for m in available_models) or ("No models found",) # Dropdown entries, in order
+        self.qmodel = QStringListModel(list(self.names), parent)
+        self.index_by_name = {name: i for i, name in enumerate(self.names)} # Dict lookups instead of findText scans
+
 class ChatWidget(QWidget):
     status_update_requested = pyqtSignal(str, int)
+    generation_started = pyqtSignal(object) # The OllamaRequestThread of a reply that just started generating
 
-    def __init__(self, ollama_url, available_models, db_manager, conversation_id, parent=None): # Added db_manager, conversation_id
+    def __init__(self, ollama_url, model_list, db_manager, db_writer, conversation_id, parent=None, http=None,
+                 ollama_model=None, preloaded_messages=None): # Added db_manager, db_writer, conversation_id
         super().__init__(parent)
         self.ollama_url = ollama_url
-        self.available_models = available_models
-        self.db_manager = db_manager
+        self.http = http # The main window's requests.Session
+        self.model_list = model_list # ModelList shared by all tabs' dropdowns
+        self._model_index_by_name = model_list.index_by_name # name -> dropdown row; this tab's own copy only when it shows a "(not found)" model
+        self.db_manager = db_manager # Reads (GUI thread)
+        self.db_writer = db_writer # Writes (DbWriterThread)
         self.conversation_id = conversation_id
+        self.ollama_model = ollama_model # From the conversation row, when the caller already has it
         
         self.messages_for_ollama_api = []  # Stores history for Ollama API (role, content, images)
         
@@ -249,13 +672,20 @@ class ChatWidget(QWidget):
         self.current_image_base64 = None
 
         self.ollama_thread = None
+        self._stream_block = None # Last QTextBlock of the reply being streamed
+        self._stream_timestamp = None
+        self._pending_tokens = [] # Stream chunks not yet shown because the tab is hidden (see showEvent)
         self.audio_thread = None
+        self.pdf_thread = None
         self.recognizer = sr.Recognizer() if sr else None
         if self.recognizer:
             self.recognizer.pause_threshold = 0.8 # seconds of non-speaking audio before a phrase is considered complete
 
         self._init_ui()
-        self.load_history_from_db() # Load history when widget is created
+        self._init_text_formats()
+        self._end_cursor = QTextCursor(self.chat_area.document()) # Reused for every live message insert
+        self._image_resource_cache = {} # (image_path, mtime) -> chat document resource name
+        self.load_history_from_db(preloaded_messages) # Load history when widget is created
 
         # Connect model dropdown change to DB update
         self.model_dropdown.currentTextChanged.connect(self.on_model_changed)
@@ -267,7 +697,7 @@ class ChatWidget(QWidget):
         model_layout = QHBoxLayout()
         model_label = QLabel("Model:")
         self.model_dropdown = QComboBox()
-        self.model_dropdown.addItems([m.get("name", "N/A") for m in self.available_models] if self.available_models else ["No models found"])
+        self.model_dropdown.setModel(self.model_list.qmodel)
         self.model_dropdown.setToolTip("Select the Ollama model for this chat.")
         model_layout.addWidget(model_label)
         model_layout.addWidget(self.model_dropdown)
@@ -293,6 +723,12 @@ class ChatWidget(QWidget):
         self.send_button.clicked.connect(self.send_message)
         self.send_button.setStyleSheet("QPushButton { background-color: #5E81AC; color: #ECEFF4; border-radius: 5px; padding: 8px; font-weight: bold; } QPushButton:hover { background-color: #81A1C1; }")
         input_layout.addWidget(self.send_button)
+        self.stop_button = QPushButton("⏹")
+        self.stop_button.setToolTip("Stop Generating")
+        self.stop_button.setEnabled(False)
+        self.stop_button.clicked.connect(self.stop_generation)
+        self.stop_button.setStyleSheet("QPushButton { background-color: #BF616A; color: #ECEFF4; border-radius: 5px; padding: 8px; font-weight: bold; } QPushButton:hover { background-color: #D08770; } QPushButton:disabled { background-color: #4C566A; }")
+        input_layout.addWidget(self.stop_button)
         self.attach_button = QPushButton("📎")
         self.attach_button.setToolTip("Attach File (Image for Vision, PDF/TXT for RAG)")
         self.attach_button.clicked.connect(self.handle_attachment)
@@ -307,50 +743,112 @@ class ChatWidget(QWidget):
         layout.addLayout(input_layout)
         self.setLayout(layout)
 
+    def _select_model(self, model_name):
+        """Selects model_name in the dropdown, shown as "<name> (not found)" if it's no longer in the model list."""
+        index = self._model_index_by_name.get(model_name, -1)
+        # Signals are blocked so neither the selection nor a placeholder is written back to the DB
+        self.model_dropdown.blockSignals(True)
+        if index < 0: # Model stored in DB not in the current model list
+            placeholder, names = f"{model_name} (not found)", self.model_list.names
+            # The shared list is used by every tab, so this tab gets its own copy with the placeholder
+            self.model_dropdown.setModel(QStringListModel([*names, placeholder], self.model_dropdown))
+            self._model_index_by_name = {**self.model_list.index_by_name, placeholder: len(names)}
+            index = len(names)
+        self.model_dropdown.setCurrentIndex(index)
+        self.model_dropdown.blockSignals(False)
+
     def on_model_changed(self, model_name):
         if self.conversation_id and model_name and model_name != "No models found":
-            self.db_manager.update_conversation_model(self.conversation_id, model_name)
+            self.db_writer.enqueue(("update_conversation_model", (model_name, self.conversation_id)))
             self.status_update_requested.emit(f"Model for this chat set to {model_name}.", 2000)
 
 
-    def _add_message_to_chat_display(self, sender, message_text, msg_timestamp, image_display_path=None):
-        """Adds a message to the chat QTextEdit display area with styling and optional image."""
-        # msg_timestamp can be a string from DB or a new one via get_timestamp()
+    def _render_message_html(self, sender, message_text, msg_timestamp, image_display_path=None):
+        """Builds the styled HTML for one message; image resources are registered on the chat document."""
+        # msg_timestamp is epoch seconds, from the DB or a new one via get_timestamp()
+        msg_timestamp = format_timestamp(msg_timestamp)
         formatted_message_prefix = ""
-        bubble_style = ""
 
         if sender.lower() == "user":
             formatted_message_prefix = f"<div style='text-align:right; margin-bottom: 8px;'><span style='color:#88C0D0; font-weight:bold;'>You ({msg_timestamp}):</span><br><div style='background-color:#3B4252; color:#D8DEE9; padding: 8px; border-radius: 8px 0px 8px 8px; display:inline-block; max-width: 70%; text-align:left;'>"
-        elif sender.lower() == "ollama":
+        elif sender.lower() in ("ollama", "assistant"): # 'assistant' is the role stored in the DB
             formatted_message_prefix = f"<div style='text-align:left; margin-bottom: 8px;'><span style='color:#A3BE8C; font-weight:bold;'>Ollama ({msg_timestamp}):</span><br><div style='background-color:#434C5E; color:#E5E9F0; padding: 8px; border-radius: 0px 8px 8px 8px; display:inline-block; max-width: 70%; text-align:left;'>"
         else: # System messages
-            system_message_html = f"<div style='text-align:center; margin-bottom: 8px;'><span style='color:#BF616A; font-style:italic;'>System ({msg_timestamp}): {message_text}</span></div>"
-            self.chat_area.append(system_message_html)
-            self.chat_area.moveCursor(QTextCursor.End)
-            return
+            return f"<div style='text-align:center; margin-bottom: 8px;'><span style='color:#BF616A; font-style:italic;'>System ({msg_timestamp}): {message_text.translate(_HTML_ESCAPE)}</span></div>"
 
-        # Escape HTML special characters for plain text messages
-        escaped_text = message_text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace("\n", "<br>")
-        message_content_html = escaped_text
+        # Escape HTML special characters for plain text messages (single pass)
+        message_content_html = message_text.translate(_HTML_ESCAPE)
 
         if image_display_path:
-            try:
-                q_img = QImage(image_display_path)
-                if not q_img.isNull():
-                    # Unique resource name for the image in QTextDocument
-                    unique_resource_name = f"image_{os.path.basename(image_display_path)}_{int(time.time()*10000)}"
-                    self.chat_area.document().addResource(QTextDocument.ImageResource, QUrl(unique_resource_name), q_img)
-                    message_content_html += f"<br><img src='{unique_resource_name}' width='150'>" # Increased width
-                else:
-                    message_content_html += f"<br><small style='color:#D08770;'>(Image not found/loadable: {os.path.basename(image_display_path)})</small>"
-            except Exception as e_img:
-                print(f"Error preparing image for display {image_display_path}: {e_img}")
-                message_content_html += f"<br><small style='color:#D08770;'>(Error displaying image: {os.path.basename(image_display_path)})</small>"
+            resource_name, notice = self._register_chat_image(image_display_path)
+            if resource_name: message_content_html += f"<br><img src='{resource_name}' width='{CHAT_IMAGE_WIDTH}'>"
+            else: message_content_html += f"<br><small style='color:#D08770;'>{notice}</small>"
         
         formatted_message_suffix = "</div></div>" # Close the inner bubble and outer div
-        full_html_message = formatted_message_prefix + message_content_html + formatted_message_suffix
-        
-        self.chat_area.append(full_html_message)
+        return formatted_message_prefix + message_content_html + formatted_message_suffix
+
+    def _register_chat_image(self, image_display_path):
+        """Adds an image to the chat document's resources. Returns (resource_name, None) or (None, notice_text)."""
+        try:
+            # One resource per (path, mtime): re-shown images reuse it instead of growing the document
+            cache_key = (image_display_path, os.path.getmtime(image_display_path))
+            if cache_key in self._image_resource_cache: return self._image_resource_cache[cache_key], None
+            q_img = _cached_chat_thumbnail(image_display_path, cache_key[1], 2 * CHAT_IMAGE_WIDTH) # 2x display width for HiDPI
+            if q_img.isNull():
+                return None, f"(Image not found/loadable: {os.path.basename(image_display_path)})"
+            resource_name = f"image_{len(self._image_resource_cache)}_{os.path.basename(image_display_path)}"
+            self.chat_area.document().addResource(QTextDocument.ImageResource, QUrl(resource_name), q_img)
+            self._image_resource_cache[cache_key] = resource_name
+            return resource_name, None
+        except OSError:
+            return None, f"(Image not found/loadable: {os.path.basename(image_display_path)})"
+        except Exception as e_img:
+            print(f"Error preparing image for display {image_display_path}: {e_img}")
+            return None, f"(Error displaying image: {os.path.basename(image_display_path)})"
+
+    def _init_text_formats(self):
+        """Builds the block/char formats used to insert live messages without HTML parsing."""
+        # Read back from _render_message_html's own output, so live and reloaded (setHtml) messages look identical
+        def formats_from_html(sender):
+            doc = QTextDocument(); doc.setHtml(self._render_message_html(sender, "x", 0))
+            header, body = doc.begin(), doc.begin().next()
+            return (header.blockFormat(), header.begin().fragment().charFormat(),
+                    body.blockFormat(), body.begin().fragment().charFormat())
+        # sender -> (header block, header chars, body block (bubble), body chars)
+        self._message_formats = {"user": formats_from_html("user"), "ollama": formats_from_html("ollama")}
+        self._message_formats["assistant"] = self._message_formats["ollama"]
+        system_block = QTextDocument(); system_block.setHtml(self._render_message_html("system", "x", 0))
+        self._system_formats = (system_block.begin().blockFormat(), system_block.begin().begin().fragment().charFormat())
+        self._notice_char_fmt = QTextCharFormat(); self._notice_char_fmt.setForeground(QColor("#D08770"))
+
+    def _start_block(self, cursor, block_format):
+        if self.chat_area.document().isEmpty(): cursor.setBlockFormat(block_format) # Reuse the initial empty block
+        else: cursor.insertBlock(block_format)
+
+    def _add_message_to_chat_display(self, sender, message_text, msg_timestamp, image_display_path=None):
+        """Adds a message to the chat QTextEdit display area with styling and optional image."""
+        cursor = self._end_cursor
+        cursor.movePosition(QTextCursor.End)
+        msg_timestamp = format_timestamp(msg_timestamp)
+        formats = self._message_formats.get(sender.lower())
+        if formats is None: # System messages
+            block_format, char_format = self._system_formats
+            self._start_block(cursor, block_format)
+            cursor.insertText(f"System ({msg_timestamp}): {message_text}", char_format)
+        else:
+            header_block, header_chars, body_block, body_chars = formats
+            label = "You" if sender.lower() == "user" else "Ollama"
+            self._start_block(cursor, header_block)
+            cursor.insertText(f"{label} ({msg_timestamp}):", header_chars)
+            cursor.insertBlock(body_block, body_chars)
+            cursor.insertText(message_text, body_chars) # Plain text: no escaping or HTML parsing needed
+            if image_display_path:
+                resource_name, notice = self._register_chat_image(image_display_path)
+                cursor.insertBlock(body_block, body_chars)
+                if resource_name:
+                    image_format = QTextImageFormat(); image_format.setName(resource_name); image_format.setWidth(CHAT_IMAGE_WIDTH)
+                    cursor.insertImage(image_format)
+                else: cursor.insertText(notice, self._notice_char_fmt)
         self.chat_area.moveCursor(QTextCursor.End)
 
     def send_message(self):
@@ -373,19 +871,16 @@ class ChatWidget(QWidget):
             message_for_api["content"] = f"Using the following document context:\n---\n{self.current_rag_text}\n---\n\nUser question: {api_content}"
         
         # Add to DB (before sending to Ollama, so it's saved even if API fails)
-        self.db_manager.add_message(
+        self.db_writer.enqueue(("add_message", (
             self.conversation_id, "user", api_content, msg_timestamp, # Store API content
-            image_path=self.current_image_path, 
-            rag_filename=self.current_rag_filename
-        )
-        
-        # Add to in-memory Ollama history (self.messages_for_ollama_api)
-        # This history should be rebuilt from DB or kept in sync carefully.
-        # For simplicity, let's rebuild it before each call based on what Ollama expects.
-        # The `get_ollama_formatted_history` method will handle this.
+            self.current_image_path,
+            self.current_rag_filename
+        )))
         
-        self.messages_for_ollama_api = self.get_ollama_formatted_history() # Get latest history
-        self.messages_for_ollama_api.append(message_for_api) # Add current message
+        # Add to in-memory Ollama history (self.messages_for_ollama_api), kept in sync with the DB incrementally.
+        # It stores what the DB stores; RAG context and images only go with the current request (below).
+        self.messages_for_ollama_api.append({"role": "user", "content": api_content})
+        self.messages_for_ollama_api = window_history(self.messages_for_ollama_api)
 
         self.input_field.clear()
         model_name = self.model_dropdown.currentText()
@@ -395,26 +890,29 @@ class ChatWidget(QWidget):
             return
 
         self.status_update_requested.emit(f"Sending to {model_name}...", 0)
-        self.send_button.setEnabled(False); self.record_button.setEnabled(False)
+        self.send_button.setEnabled(False); self.record_button.setEnabled(False); self.stop_button.setEnabled(True)
 
         images_payload = [self.current_image_base64] if self.current_image_base64 else None
-        if images_payload: # If sending an image, add it to the last message in API history
-            self.messages_for_ollama_api[-1]["images"] = images_payload
+        if images_payload: # If sending an image, add it to the current message
+            message_for_api["images"] = images_payload
+        request_messages = self.messages_for_ollama_api[:-1] + [message_for_api]
 
-
-        self.ollama_thread = OllamaRequestThread(self.ollama_url, model_name, self.messages_for_ollama_api, images=None) # Images are now part of messages
+        self._stream_block = None
+        self.ollama_thread = OllamaRequestThread(self.ollama_url, model_name, request_messages, stream=True, images=None, http=self.http) # Images are now part of messages
+        self.ollama_thread.chunk_received.connect(self.handle_ollama_chunk)
         self.ollama_thread.response_received.connect(self.handle_ollama_response)
         self.ollama_thread.error_occurred.connect(self.handle_ollama_error)
         self.ollama_thread.finished.connect(self._on_ollama_thread_finished)
         self.ollama_thread.start()
+        self.generation_started.emit(self.ollama_thread)
 
         self.current_image_path = None; self.current_image_base64 = None # Clear after sending
         # RAG context (self.current_rag_text, self.current_rag_filename) persists until explicitly changed/cleared.
         self._update_context_label()
 
     def get_ollama_formatted_history(self):
-        """ Retrieves messages from DB and formats them for Ollama API """
-        db_messages = self.db_manager.get_messages(self.conversation_id)
+        """ Retrieves the recent messages window from DB and formats them for Ollama API (send_message keeps it in memory instead) """
+        db_messages = self.db_manager.get_messages_tail(self.conversation_id, OLLAMA_HISTORY_MAX_MESSAGES)
         ollama_history = []
         for msg_row in db_messages:
             entry = {"role": msg_row["role"], "content": msg_row["content"]}
@@ -424,31 +922,77 @@ class ChatWidget(QWidget):
             # For true multi-turn vision, the API message list needs careful construction.
             # For now, images are only sent with the *current* user message.
             ollama_history.append(entry)
-        return ollama_history
+        return window_history(ollama_history)
+
+
+    def handle_ollama_chunk(self, chunk):
+        """Appends a streamed piece of the reply; while the tab is hidden chunks are only buffered."""
+        if self._stream_block is None and not self._pending_tokens: self._stream_timestamp = get_timestamp() # First chunk
+        self._pending_tokens.append(chunk)
+        if self.isVisible(): self._flush_pending_tokens()
+
+    def _flush_pending_tokens(self):
+        """Writes buffered chunks to the Ollama bubble in one insert, creating the bubble if needed."""
+        if not self._pending_tokens: return
+        text = "".join(self._pending_tokens); self._pending_tokens.clear()
+        if self._stream_block is None:
+            self._add_message_to_chat_display("Ollama", "", self._stream_timestamp)
+            self._stream_block = self.chat_area.document().lastBlock()
+        # Track the block rather than a position so messages appended meanwhile don't shift the insert point
+        cursor = QTextCursor(self._stream_block)
+        cursor.movePosition(QTextCursor.EndOfBlock)
+        cursor.insertText(text, self._message_formats["ollama"][3]) # Body style, not the header's
+        self._stream_block = cursor.block()
+        self.chat_area.moveCursor(QTextCursor.End)
 
+    def showEvent(self, event):
+        # Background tabs skip per-chunk document layout; catch up in one insert when shown
+        self._flush_pending_tokens()
+        super().showEvent(event)
 
     def handle_ollama_response(self, response_data):
         ai_reply = response_data.get("message", {}).get("content", "No proper response.")
-        msg_timestamp = get_timestamp()
-        
-        # Add to UI
-        self._add_message_to_chat_display("Ollama", ai_reply, msg_timestamp)
+        self._flush_pending_tokens() # Complete the bubble even if the tab is still hidden
+        if self._stream_block is not None: # Already displayed chunk by chunk
+            msg_timestamp = self._stream_timestamp
+            self._stream_block = None
+        else:
+            msg_timestamp = get_timestamp()
+            # Add to UI
+            self._add_message_to_chat_display("Ollama", ai_reply, msg_timestamp)
         
-        # Add to DB
-        self.db_manager.add_message(self.conversation_id, "assistant", ai_reply, msg_timestamp)
+        # Add to DB (only the complete reply is persisted; not at all once the conversation was deleted)
+        if self.conversation_id is not None:
+            self.db_writer.enqueue(("add_message", (self.conversation_id, "assistant", ai_reply, msg_timestamp, None, None)))
         
         # Update in-memory API history
         self.messages_for_ollama_api.append({"role": "assistant", "content": ai_reply})
+        self.messages_for_ollama_api = window_history(self.messages_for_ollama_api)
         
-        self.status_update_requested.emit(f"Response from {self.model_dropdown.currentText()}.", 3000)
+        if response_data.get("cancelled"): self.status_update_requested.emit("Generation stopped.", 3000)
+        else: self.status_update_requested.emit(f"Response from {self.model_dropdown.currentText()}.", 3000)
 
     def handle_ollama_error(self, error_message):
+        self._flush_pending_tokens() # Keep any partial reply above the error
         timestamp = get_timestamp()
         self._add_message_to_chat_display("System", f"Error: {error_message}", timestamp)
         # We don't add this system error to DB usually, but could if needed for audit.
         self.status_update_requested.emit(f"Error: {error_message}", 5000)
 
+    def stop_generation(self):
+        if self.ollama_thread and self.ollama_thread.isRunning():
+            self.ollama_thread.cancel()
+            self.stop_button.setEnabled(False)
+            self.status_update_requested.emit("Stopping generation...", 0)
+
+    def discard(self):
+        """Called when the conversation is deleted: stops generation, and nothing from this widget is saved anymore."""
+        self.conversation_id = None
+        if self.ollama_thread is not None: self.ollama_thread.cancel()
+
     def _on_ollama_thread_finished(self):
+        self._stream_block = None
+        self.stop_button.setEnabled(False)
         self.send_button.setEnabled(True)
         if sr: self.record_button.setEnabled(True)
         self.ollama_thread = None
@@ -464,7 +1008,7 @@ class ChatWidget(QWidget):
         if file_ext in ['.png', '.jpg', '.jpeg']:
             # For simplicity, let's copy image to an app-specific data dir if we want to make paths more robust
             # For now, just use original path. User must not move/delete it.
-            self.current_image_base64 = to_base64(file_path)
+            self.current_image_base64 = prepare_image_base64(file_path) # Downscaled JPEG, kept in memory until sent
             if self.current_image_base64:
                 self.current_image_path = file_path # Store original path
                 self.current_rag_text = None; self.current_rag_filename = None # Clear RAG
@@ -473,18 +1017,17 @@ class ChatWidget(QWidget):
             else:
                 self._add_message_to_chat_display("System", f"Failed to load image '{filename}'.", timestamp)
         elif file_ext == '.pdf' and PyPDF2:
-            try:
-                text = ""
-                with open(file_path, "rb") as f:
-                    reader = PyPDF2.PdfReader(f)
-                    for page in reader.pages: text += (page.extract_text() or "") + "\n"
-                self.current_rag_text = text.strip(); self.current_rag_filename = filename
-                self.current_image_path = None; self.current_image_base64 = None # Clear vision
-                self._add_message_to_chat_display("System", f"PDF '{filename}' loaded for RAG.", timestamp)
-            except Exception as e: self._add_message_to_chat_display("System", f"Error reading PDF '{filename}': {e}", timestamp)
+            if self.pdf_thread and self.pdf_thread.isRunning(): self.status_update_requested.emit("A PDF is still being extracted...", 2000); return
+            # Extraction can take seconds on large PDFs; keep it off the GUI thread
+            self.pdf_thread = PdfExtractThread(file_path)
+            self.pdf_thread.text_ready.connect(lambda text: self.handle_pdf_text(filename, text))
+            self.pdf_thread.extraction_error.connect(lambda err: self.handle_pdf_error(filename, err))
+            self.pdf_thread.finished.connect(self._on_pdf_thread_finished)
+            self.status_update_requested.emit(f"Extracting text from '{filename}'...", 0)
+            self.pdf_thread.start()
         elif file_ext == '.txt':
             try:
-                with open(file_path, "r", encoding='utf-8') as f: self.current_rag_text = f.read().strip()
+                with open(file_path, "rb") as f: self.current_rag_text = f.read().decode('utf-8', 'replace').strip() # One read + decode
                 self.current_rag_filename = filename
                 self.current_image_path = None; self.current_image_base64 = None
                 self._add_message_to_chat_display("System", f"Text file '{filename}' loaded for RAG.", timestamp)
@@ -493,6 +1036,20 @@ class ChatWidget(QWidget):
             self._add_message_to_chat_display("System", f"Unsupported file: {filename}", timestamp)
         self._update_context_label()
 
+    def handle_pdf_text(self, filename, text):
+        self.current_rag_text = text; self.current_rag_filename = filename
+        self.current_image_path = None; self.current_image_base64 = None # Clear vision
+        self._add_message_to_chat_display("System", f"PDF '{filename}' loaded for RAG.", get_timestamp())
+        self.status_update_requested.emit(f"PDF '{filename}' loaded.", 3000)
+        self._update_context_label()
+
+    def handle_pdf_error(self, filename, error_message):
+        self._add_message_to_chat_display("System", f"Error reading PDF '{filename}': {error_message}", get_timestamp())
+        self.status_update_requested.emit(f"Could not read PDF '{filename}'.", 5000) # Replaces the "Extracting..." message
+
+    def _on_pdf_thread_finished(self):
+        self.pdf_thread = None
+
     def _update_context_label(self):
         if self.current_image_path: self.context_label.setText(f"Context: Image - {os.path.basename(self.current_image_path)}"); self.context_label.setStyleSheet("font-size: 9pt; color: #8FBCBB;")
         elif self.current_rag_filename: self.context_label.setText(f"Context: Document - {self.current_rag_filename}"); self.context_label.setStyleSheet("font-size: 9pt; color: #EBCB8B;")
@@ -552,33 +1109,33 @@ class ChatWidget(QWidget):
         self.record_button.setText("🎤"); self.record_button.setEnabled(True); self.send_button.setEnabled(True)
         self.audio_thread = None
 
-    def load_history_from_db(self):
+    def load_history_from_db(self, preloaded_messages=None):
+        """Renders the conversation history; preloaded_messages (rows, oldest first) skips the DB read."""
         self.chat_area.clear()
+        self._image_resource_cache.clear() # Clearing the document drops its resources
         self.messages_for_ollama_api = [] # Reset API history
-        db_messages = self.db_manager.get_messages(self.conversation_id)
+        if preloaded_messages is not None: db_messages = preloaded_messages
+        else: db_messages = self.db_manager.get_messages_tail(self.conversation_id, HISTORY_DISPLAY_LIMIT)
         
-        current_model_in_db = None
-        if db_messages: # Try to get model from last assistant message or conversation table
-            conv_details = self.db_manager.conn.execute("SELECT ollama_model FROM conversations WHERE id = ?", (self.conversation_id,)).fetchone()
-            if conv_details and conv_details['ollama_model']:
-                current_model_in_db = conv_details['ollama_model']
-
-        if current_model_in_db:
-            index = self.model_dropdown.findText(current_model_in_db, Qt.MatchFixedString)
-            if index >= 0: self.model_dropdown.setCurrentIndex(index)
+        current_model_in_db = self.ollama_model
+        if current_model_in_db is None and db_messages: # Not passed in by the caller: read it from the conversation row
+            current_model_in_db = self.db_manager.get_conversation_model(self.conversation_id)
+
+        if current_model_in_db: self._select_model(current_model_in_db)
         
-        for msg_row in db_messages:
-            # Add to UI display
-            self._add_message_to_chat_display(
-                msg_row["role"], 
-                msg_row["content"], 
-                msg_row["timestamp"], 
-                image_display_path=msg_row["image_path"]
-            )
-            # Rebuild API history (simplified, no images for past messages here)
-            self.messages_for_ollama_api.append({"role": msg_row["role"], "content": msg_row["content"]})
+        self._bulk_load_messages(db_messages)
+        # Rebuild API history (simplified, no images for past messages here).
+        # Rows are (id, role, content, timestamp, image_path, rag_filename), unpacked positionally rather than by column name.
+        self.messages_for_ollama_api = window_history([{"role": role, "content": content} for _id, role, content, *_ in db_messages])
         self.status_update_requested.emit("Chat history loaded.", 1500)
 
+    def _bulk_load_messages(self, rows):
+        """Renders history rows with a single setHtml; _add_message_to_chat_display is only for live messages."""
+        if not rows: return
+        self.chat_area.setHtml("".join(self._render_message_html(role, content, timestamp, image_display_path=image_path)
+                                       for _id, role, content, timestamp, image_path, _rag in rows))
+        self.chat_area.moveCursor(QTextCursor.End)
+
 
 # --- Main Application Window ---
 class OllamaApp(QMainWindow):
@@ -586,10 +1143,21 @@ class OllamaApp(QMainWindow):
         super().__init__()
         self.ollama_url = DEFAULT_OLLAMA_URL
         self.available_models = []
+        self._update_model_list()
+        self.http = create_http_session() # Shared with every ChatWidget
+        self._model_loader_thread = None # Set while /api/tags is being fetched
+        self._model_loader = None
+        self._models_reload_pending = False # Another fetch was requested while one was running
+        self._tags_cache = {} # ollama_url -> (time.monotonic() when fetched, models)
+        self._export_thread = None # Set while a chat export is being written
+        self._generation_threads = set() # Replies still generating; only then does exit ask for confirmation
+        self.chat_sessions_count = 0 # Conversations in the DB; kept live so "New Chat" needn't COUNT(*)
         self.db_manager = DatabaseManager() # Initialize DB Manager
+        self.db_writer = DbWriterThread() # Off-GUI-thread message writes
+        self.db_writer.error_occurred.connect(lambda msg: self.update_status_bar(msg, 5000))
+        self.db_writer.start()
 
         self._init_ui()
-        self._apply_stylesheet()
         self._load_ollama_models() # This will also trigger loading chats from DB if models load
 
     def _init_ui(self):
@@ -602,6 +1170,7 @@ class OllamaApp(QMainWindow):
         self.tab_widget.setTabsClosable(True)
         self.tab_widget.setMovable(True) # Allow reordering tabs
         self.tab_widget.tabCloseRequested.connect(self.close_tab_view) # Just closes view
+        self.tab_widget.currentChanged.connect(self._materialize_tab) # Build ChatWidgets lazily
         self.tab_widget.setContextMenuPolicy(Qt.CustomContextMenu) # For right-click menu
         self.tab_widget.customContextMenuRequested.connect(self.show_tab_context_menu)
         main_layout.addWidget(self.tab_widget)
@@ -624,83 +1193,133 @@ class OllamaApp(QMainWindow):
         self.setStatusBar(self.status_bar)
         self.status_bar.showMessage("Ready.", 3000)
 
-    def _apply_stylesheet(self): # Using previous stylesheet, ensure it's fine
-        self.setStyleSheet("""
-            QMainWindow, QWidget { background-color: #2E3440; color: #D8DEE9; font-family: Inter, sans-serif; }
-            QTabWidget::pane { border-top: 2px solid #4C566A; }
-            QTabBar::tab { background: #3B4252; color: #D8DEE9; border: 1px solid #4C566A; border-bottom-color: #3B4252; padding: 8px 15px; margin-right: 2px; border-top-left-radius: 4px; border-top-right-radius: 4px; }
-            QTabBar::tab:selected { background: #434C5E; color: #ECEFF4; border-bottom-color: #434C5E; }
-            QTabBar::tab:hover { background: #4C566A; }
-            /* QTabBar::close-button styling might be OS dependent or need specific icons */
-            QPushButton { background-color: #5E81AC; color: #ECEFF4; border: none; padding: 8px 12px; border-radius: 4px; font-weight: bold; }
-            QPushButton:hover { background-color: #81A1C1; } QPushButton:pressed { background-color: #4C566A; }
-            QLineEdit, QTextEdit, QComboBox { background-color: #3B4252; color: #D8DEE9; border: 1px solid #4C566A; border-radius: 4px; padding: 6px; }
-            QComboBox::drop-down { border: none; }
-            QLabel { color: #D8DEE9; } QStatusBar { background-color: #3B4252; color: #ECEFF4; }
-            QMenuBar { background-color: #3B4252; color: #ECEFF4; }
-            QMenuBar::item { background-color: #3B4252; color: #ECEFF4; padding: 4px 8px; }
-            QMenuBar::item:selected { background-color: #4C566A; }
-            QMenu { background-color: #3B4252; color: #ECEFF4; border: 1px solid #4C566A; }
-            QMenu::item:selected { background-color: #5E81AC; }
-        """)
-
     def _load_ollama_models(self):
+        """Starts fetching the model list on a worker thread; _on_models_loaded continues on the GUI thread."""
+        if self._model_loader_thread is not None: # Already loading: fetch again for the current URL once it ends
+            self._models_reload_pending = True
+            self.status_bar.showMessage("Still fetching Ollama models; will reload for the new URL...", 3000); return
+        cached = self._tags_cache.get(self.ollama_url)
+        if cached and time.monotonic() - cached[0] < MODEL_LIST_CACHE_SECONDS: # e.g. the URL was switched back
+            self._on_models_loaded(cached[1], None); return
         self.status_bar.showMessage("Fetching Ollama models...", 0)
-        try:
-            response = requests.get(f"{self.ollama_url}/api/tags", timeout=10)
-            response.raise_for_status(); data = response.json()
-            self.available_models = data.get("models", [])
+        self._model_loader_thread = QThread()
+        self._model_loader = ModelLoaderWorker(self.http, self.ollama_url)
+        self._model_loader.moveToThread(self._model_loader_thread)
+        self._model_loader_thread.started.connect(self._model_loader.run)
+        self._model_loader.finished.connect(self._on_models_loaded)
+        # Direct: quit the loader's event loop from the worker itself, so closeEvent's wait() can't deadlock on a queued quit
+        self._model_loader.finished.connect(self._model_loader_thread.quit, Qt.DirectConnection)
+        self._model_loader_thread.finished.connect(self._on_model_loader_thread_finished)
+        self._model_loader_thread.start()
+
+    def _on_models_loaded(self, models, error):
+        fetched_url = self._model_loader.ollama_url if self._model_loader is not None else self.ollama_url
+        if self._model_loader is not None: # Fresh fetch (not a cache hit): remember or forget it for this URL
+            if error is None: self._tags_cache[fetched_url] = (time.monotonic(), models)
+            else: self._tags_cache.pop(fetched_url, None)
+        if fetched_url != self.ollama_url: return # URL changed meanwhile; the pending reload replaces this result
+        if error is None:
+            self.available_models = models
+            self._update_model_list()
             if not self.available_models:
                 self.status_bar.showMessage("No Ollama models. Check Ollama.", 5000)
                 QMessageBox.warning(self, "Ollama Models", "No models found. Ensure Ollama is running and models are pulled.")
             else:
                 self.status_bar.showMessage(f"{len(self.available_models)} models loaded.", 3000)
-            self.load_conversations_from_db() # Load chats after models are known
-        except requests.exceptions.ConnectionError:
+        elif isinstance(error, requests.exceptions.ConnectionError):
             self.status_bar.showMessage("Ollama connection error.", 5000)
-            QMessageBox.critical(self, "Ollama Error", f"Could not connect to Ollama at {self.ollama_url}.")
-            self.load_conversations_from_db() # Still try to load chats, they might use a model not currently available
-        except Exception as e:
-            self.status_bar.showMessage(f"Error fetching models: {e}", 5000)
-            self.load_conversations_from_db()
-
+            QMessageBox.critical(self, "Ollama Error", f"Could not connect to Ollama at {fetched_url}.")
+        else:
+            self.status_bar.showMessage(f"Error fetching models: {error}", 5000)
+        # Load chats after models are known; on errors still try, they might use a model not currently available
+        self.load_conversations_from_db()
+
+    def _on_model_loader_thread_finished(self):
+        self._model_loader.deleteLater(); self._model_loader_thread.deleteLater()
+        self._model_loader = None; self._model_loader_thread = None
+        if self._models_reload_pending: # Settings changed the URL while the previous fetch was running
+            self._models_reload_pending = False
+            self._load_ollama_models()
+
+    def _update_model_list(self):
+        """Builds the model-name list once and shares it with every new ChatWidget."""
+        # A new ModelList each time: tabs already open keep their list and current selection
+        self._model_list = ModelList(self.available_models, self)
 
     def load_conversations_from_db(self):
         """Loads all conversations from DB and creates/updates tabs."""
-        # Clear existing tabs before loading (or implement more complex tab matching)
-        # For simplicity now, clear and reload. This might lose unsaved state in non-DB parts.
-        # while self.tab_widget.count() > 0:
-        #     self.tab_widget.removeTab(0)
+        # On a reload (e.g. after changing the Ollama URL) opened chats keep their tab and state;
+        # unopened placeholders hold nothing, so they are dropped in one go and re-added below
+        open_ids = {w.conversation_id for w in map(self.tab_widget.widget, range(self.tab_widget.count())) if isinstance(w, ChatWidget)}
+        self._close_tabs_bulk([i for i in range(self.tab_widget.count()) if not isinstance(self.tab_widget.widget(i), ChatWidget)])
 
         conversations = self.db_manager.get_all_conversations()
+        self.chat_sessions_count = len(conversations)
         if not conversations and not self.available_models: # No chats and no models
              self.status_bar.showMessage("No chats in DB and no models from Ollama.", 3000)
         elif not conversations and self.available_models: # No chats but models exist
              self.add_new_chat_tab_action("Default Chat") # Create one default chat
         else:
-            for conv_row in conversations:
-                self.add_chat_tab_from_db(conv_row['id'], conv_row['name'], conv_row['ollama_model'])
+            for conv_row in conversations: # Lightweight placeholders; ChatWidgets are built when first shown
+                if conv_row['id'] not in open_ids: self.add_chat_placeholder(conv_row['id'], conv_row['name'], conv_row['ollama_model'])
+            self._materialize_tab(self.tab_widget.currentIndex()) # No-op unless the current tab is a placeholder
         
         if self.tab_widget.count() == 0 and self.available_models: # If DB was empty but models exist
             self.add_new_chat_tab_action("Default Chat")
 
 
-    def add_chat_tab_from_db(self, conversation_id, name, ollama_model):
-        """Adds a tab for an existing conversation from the database."""
-        chat_widget = ChatWidget(self.ollama_url, self.available_models, self.db_manager, conversation_id, self)
-        chat_widget.status_update_requested.connect(self.update_status_bar)
-        
+    def _close_tabs_bulk(self, indices):
+        """Removes several tabs with a single tab-bar relayout/repaint (widgets are deleted later, as in close_tab_view)."""
+        if not indices: return
+        self.tab_widget.setUpdatesEnabled(False); self.tab_widget.blockSignals(True)
+        for index in sorted(indices, reverse=True): # Descending, so earlier removals don't shift later indices
+            widget = self.tab_widget.widget(index)
+            self.tab_widget.removeTab(index)
+            if widget is not None: widget.deleteLater()
+        self.tab_widget.blockSignals(False); self.tab_widget.setUpdatesEnabled(True)
+        self.tab_widget.update()
+
+    def add_chat_placeholder(self, conversation_id, name, ollama_model):
+        """Adds a tab for a stored conversation without building its ChatWidget (see _materialize_tab)."""
+        placeholder = QWidget()
+        placeholder.setProperty("conv_meta", {"conversation_id": conversation_id, "name": name, "ollama_model": ollama_model})
+        self.tab_widget.addTab(placeholder, name)
+
+    def _materialize_tab(self, index):
+        """Swaps a placeholder tab for its real ChatWidget the first time it becomes current."""
+        placeholder = self.tab_widget.widget(index)
+        if placeholder is None or isinstance(placeholder, ChatWidget): return
+        meta = placeholder.property("conv_meta")
+        if not meta: return
+        chat_widget = self._create_chat_widget(meta["conversation_id"], meta["ollama_model"])
+        name = self.tab_widget.tabText(index) # May have been renamed while still a placeholder
+        self.tab_widget.blockSignals(True) # removeTab would otherwise re-enter via currentChanged
+        self.tab_widget.removeTab(index)
+        self.tab_widget.insertTab(index, chat_widget, name)
+        self.tab_widget.setCurrentIndex(index)
+        self.tab_widget.blockSignals(False)
+        placeholder.deleteLater()
+
+    def _conversation_id_at(self, index):
+        """Conversation id of a tab, whether it holds a ChatWidget or a placeholder."""
+        widget = self.tab_widget.widget(index)
+        if isinstance(widget, ChatWidget): return widget.conversation_id
+        meta = widget.property("conv_meta") if widget is not None else None
+        return meta["conversation_id"] if meta else None
+
+    def add_chat_tab_from_db(self, conversation_id, name, ollama_model, preloaded_messages=None):
+        """Adds and selects a tab for an existing conversation from the database."""
+        chat_widget = self._create_chat_widget(conversation_id, ollama_model, preloaded_messages)
         index = self.tab_widget.addTab(chat_widget, name)
         self.tab_widget.setCurrentIndex(index)
-        
-        # Set model in dropdown if it was stored
-        if ollama_model:
-            model_idx = chat_widget.model_dropdown.findText(ollama_model, Qt.MatchFixedString)
-            if model_idx >= 0:
-                chat_widget.model_dropdown.setCurrentIndex(model_idx)
-            else: # Model stored in DB not in current available_models list
-                chat_widget.model_dropdown.addItem(f"{ollama_model} (not found)") # Add it as a placeholder
-                chat_widget.model_dropdown.setCurrentText(f"{ollama_model} (not found)")
+
+    def _create_chat_widget(self, conversation_id, ollama_model, preloaded_messages=None):
+        # The conversation row is already known here, so ChatWidget doesn't query it again
+        chat_widget = ChatWidget(self.ollama_url, self._model_list, self.db_manager, self.db_writer, conversation_id, self,
+                                 http=self.http, ollama_model=ollama_model, preloaded_messages=preloaded_messages)
+        chat_widget.status_update_requested.connect(self.update_status_bar)
+        chat_widget.generation_started.connect(self._on_generation_started)
+        return chat_widget
 
 
     def add_new_chat_tab_action(self, name=None):
@@ -710,14 +1329,13 @@ class OllamaApp(QMainWindow):
             if reply == QMessageBox.No: return
 
         default_model = self.available_models[0]['name'] if self.available_models else None
-        
-        self.chat_sessions_count = self.db_manager.conn.execute("SELECT COUNT(*) FROM conversations").fetchone()[0]
         tab_name = name if name else f"Chat {self.chat_sessions_count + 1}"
         
         # Create conversation in DB first
         conversation_id = self.db_manager.add_conversation(tab_name, default_model)
         if conversation_id:
-            self.add_chat_tab_from_db(conversation_id, tab_name, default_model) # Load it like any other DB chat
+            self.chat_sessions_count += 1
+            self.add_chat_tab_from_db(conversation_id, tab_name, default_model, preloaded_messages=[]) # Brand new: no history to query
             self.status_bar.showMessage(f"New chat '{tab_name}' created.", 2000)
         else:
             QMessageBox.critical(self, "Database Error", "Could not create new conversation in the database.")
@@ -746,10 +1364,9 @@ class OllamaApp(QMainWindow):
 
     def rename_chat_tab(self, index):
         current_name = self.tab_widget.tabText(index)
-        chat_widget = self.tab_widget.widget(index)
-        if not isinstance(chat_widget, ChatWidget): return
+        conversation_id = self._conversation_id_at(index) # Works for not-yet-opened (placeholder) tabs too
+        if conversation_id is None: return
 
-        conversation_id = chat_widget.conversation_id
         new_name, ok = QInputDialog.getText(self, "Rename Chat", "Enter new name:", QLineEdit.Normal, current_name)
         if ok and new_name and new_name != current_name:
             self.tab_widget.setTabText(index, new_name)
@@ -758,16 +1375,20 @@ class OllamaApp(QMainWindow):
 
     def delete_chat_tab_permanently(self, index):
         current_name = self.tab_widget.tabText(index)
-        chat_widget = self.tab_widget.widget(index)
-        if not isinstance(chat_widget, ChatWidget): return
+        conversation_id = self._conversation_id_at(index)
+        if conversation_id is None: return
         
-        conversation_id = chat_widget.conversation_id
         reply = QMessageBox.question(self, 'Delete Chat Permanently',
                                      f"Delete '{current_name}' and all its messages from the database? This cannot be undone.",
                                      QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
         if reply == QMessageBox.Yes:
+            widget = self.tab_widget.widget(index)
+            if isinstance(widget, ChatWidget): widget.discard() # A reply still streaming must not be saved afterwards
+            self.db_writer.flush() # Pending inserts would violate the FK once the conversation is gone
             self.db_manager.delete_conversation(conversation_id)
-            self.tab_widget.removeTab(index) # This also calls widget.deleteLater()
+            self.chat_sessions_count = max(0, self.chat_sessions_count - 1)
+            self.tab_widget.removeTab(index) # removeTab doesn't delete the page widget
+            widget.deleteLater()
             self.status_bar.showMessage(f"Chat '{current_name}' deleted permanently.", 3000)
 
     def update_status_bar(self, message, timeout=3000):
@@ -796,50 +1417,61 @@ class OllamaApp(QMainWindow):
         current_widget = self.tab_widget.currentWidget()
         if not isinstance(current_widget, ChatWidget): QMessageBox.information(self, "Export Chat", "No active chat to export."); return
 
+        if self._export_thread is not None: QMessageBox.information(self, "Export Chat", "An export is already running."); return
+
         conversation_id = current_widget.conversation_id
         chat_name = self.tab_widget.tabText(self.tab_widget.currentIndex())
-        messages = self.db_manager.get_messages(conversation_id) # Get messages from DB
+        self.db_writer.flush() # Include messages still queued for writing
 
-        if not messages: QMessageBox.information(self, "Export Chat", "Chat history is empty."); return
+        if not self.db_manager.get_messages_tail(conversation_id, 1): QMessageBox.information(self, "Export Chat", "Chat history is empty."); return
 
-        file_path, _ = QFileDialog.getSaveFileName(self, f"Export Chat '{chat_name}'", f"{chat_name}.json", "JSON Files (*.json);;Text Files (*.txt)")
+        file_path, selected_filter = QFileDialog.getSaveFileName(self, f"Export Chat '{chat_name}'", f"{chat_name}.json", "JSON Files (*.json);;Text Files (*.txt)")
         if not file_path: return
+        if not file_path.endswith((".json", ".txt")): # No (known) extension typed: use the format picked in the dialog
+            file_path += ".txt" if "*.txt" in selected_filter else ".json"
 
-        try:
-            history_for_export = [{"role": m["role"], "content": m["content"], "timestamp": m["timestamp"], 
-                                   "image_path": m["image_path"], "rag_filename": m["rag_filename"]} for m in messages]
-            if file_path.endswith(".json"):
-                with open(file_path, 'w', encoding='utf-8') as f: json.dump(history_for_export, f, indent=2)
-            elif file_path.endswith(".txt"):
-                with open(file_path, 'w', encoding='utf-8') as f:
-                    f.write(f"Chat History: {chat_name} - Exported: {get_timestamp()}\n")
-                    f.write(f"Model (last used in tab): {current_widget.model_dropdown.currentText()}\n\n")
-                    for message in history_for_export:
-                        f.write(f"[{message['timestamp']}] {message['role'].capitalize()}:\n{message['content']}\n")
-                        if message['image_path']: f.write(f"(Image: {os.path.basename(message['image_path'])})\n")
-                        if message['rag_filename']: f.write(f"(RAG Doc: {message['rag_filename']})\n")
-                        f.write("\n---\n\n")
-            self.status_bar.showMessage(f"Chat exported to {os.path.basename(file_path)}", 3000)
-        except Exception as e: QMessageBox.critical(self, "Export Error", f"Could not export chat: {e}")
+        # Rows are read and written on the export thread, so long chats neither block the UI nor sit in memory
+        self._export_thread = ExportChatThread(conversation_id, file_path, chat_name, current_widget.model_dropdown.currentText())
+        self._export_thread.progress.connect(lambda count: self.status_bar.showMessage(f"Exporting... {count} messages written", 0))
+        self._export_thread.export_finished.connect(lambda message: self.status_bar.showMessage(message, 3000))
+        self._export_thread.export_error.connect(lambda error: QMessageBox.critical(self, "Export Error", f"Could not export chat: {error}"))
+        self._export_thread.finished.connect(self._on_export_thread_finished)
+        self.status_bar.showMessage(f"Exporting '{chat_name}'...", 0)
+        self._export_thread.start()
+
+    def _on_export_thread_finished(self):
+        self._export_thread.deleteLater(); self._export_thread = None
 
 
     def show_about_dialog(self):
         QMessageBox.about(self, f"About {APP_TITLE}", f"<h2>{APP_TITLE} v{VERSION}</h2><p>Multi-conversation Ollama client with Vision, RAG, Speech-to-Text, and SQLite persistence.</p><p>Ollama URL: {self.ollama_url}</p><p>Database: {os.path.abspath(DATABASE_NAME)}</p>")
 
+    def _on_generation_started(self, thread):
+        # Tracked through the thread itself: its tab may be closed (and the ChatWidget deleted) before it finishes.
+        # Holding the reference also keeps the QThread alive until it has actually stopped.
+        self._generation_threads.add(thread)
+        thread.finished.connect(lambda: self._generation_threads.discard(thread))
+
     def closeEvent(self, event):
-        # DB connection is closed when db_manager is garbage collected or explicitly if needed
-        # self.db_manager.close() # Ensure DB is closed cleanly
-        reply = QMessageBox.question(self, 'Exit Application', "Are you sure you want to exit?", QMessageBox.Yes | QMessageBox.No, QMessageBox.Yes)
-        if reply == QMessageBox.Yes: event.accept()
-        else: event.ignore()
+        # Everything else is already in SQLite, so only an in-flight reply is worth a confirmation prompt
+        if self._generation_threads:
+            reply = QMessageBox.question(self, 'Exit Application', "A reply is still being generated. Exit anyway?", QMessageBox.Yes | QMessageBox.No, QMessageBox.Yes)
+            if reply != QMessageBox.Yes: event.ignore(); return
+        self.db_writer.flush() # Commit queued writes before the window goes away (the writer is stopped after exec_)
+        event.accept()
+        if self._model_loader_thread is not None: self._model_loader_thread.wait() # Bounded by OLLAMA_TAGS_TIMEOUT
+        if self._export_thread is not None: self._export_thread.wait() # Let a running export finish its file
+        self.http.close()
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)
+    app.setStyleSheet(_STYLESHEET)
     # Consider setting app icon here
     # app.setWindowIcon(QIcon("path/to/your/icon.png"))
     main_window = OllamaApp()
     main_window.show()
     exit_code = app.exec_()
+    main_window.db_writer.stop() # Flush queued writes before closing
     main_window.db_manager.close() # Explicitly close DB connection on exit
     sys.exit(exit_code)
 